@@ -0,0 +1,307 @@
+import io
+import gzip
+import json
+import time
+import base64
+import hashlib
+import logging
+import argparse
+import threading
+import importlib
+import contextlib
+import urllib.request
+import urllib.response
+from email.message import Message
+
+# Records external API traffic (Zoo via requests, OpenAI via httpx, Google Speech via urllib)
+# at the transport level into gzip-compressed JSON-lines cassettes, and replays it so the
+# pipeline can be profiled offline without live service latency.
+
+# Response headers that describe the wire encoding or session rather than the content
+_DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "set-cookie", "connection"}
+
+
+class CassetteMissError(LookupError):
+    """Raised during replay when a request has no recorded response."""
+
+
+def _body_hash(body):
+    if body is None:
+        body = b""
+    elif isinstance(body, str):
+        body = body.encode("utf-8")
+    return hashlib.sha256(body).hexdigest()
+
+
+def _encode_body(body):
+    try:
+        return {"text": body.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"base64": base64.b64encode(body).decode("ascii")}
+
+
+def _decode_body(interaction):
+    if "text" in interaction:
+        return interaction["text"].encode("utf-8")
+    return base64.b64decode(interaction["base64"])
+
+
+def _clean_headers(headers):
+    return [(k, v) for k, v in headers if k.lower() not in _DROPPED_HEADERS]
+
+
+class Cassette:
+    """
+    An ordered list of recorded request/response interactions.
+
+    Replay serves interactions for the same method, URL and request body in recorded order,
+    so repeated status polls get the same sequence of responses they got when recorded.
+    """
+
+    def __init__(self, path, interactions=None, strict=False):
+        self.path = path
+        self.interactions = interactions or []
+        self.strict = strict  # Refuse to serve a response recorded for a different request body
+        self._used = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, strict=False):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return cls(path, [json.loads(line) for line in f if line.strip()], strict=strict)
+
+    def save(self):
+        with gzip.open(self.path, "wt", encoding="utf-8") as f:
+            for interaction in self.interactions:
+                f.write(json.dumps(interaction, separators=(",", ":")) + "\n")
+        logging.info(f"Cassette saved: {self.path} ({len(self.interactions)} interactions)")
+
+    def append(self, transport, method, url, request_body, status, headers, body, elapsed):
+        with self._lock:
+            self.interactions.append(dict(
+                transport=transport, method=method, url=url, request_hash=_body_hash(request_body),
+                status=status, headers=_clean_headers(headers), elapsed=round(elapsed, 4),
+                **_encode_body(body),
+            ))
+
+    def next_response(self, transport, method, url, request_body):
+        """
+        Finds the first unused interaction matching the request, preferring an exact body match.
+        """
+        request_hash = _body_hash(request_body)
+        with self._lock:
+            fallback = None
+            for i, interaction in enumerate(self.interactions):
+                if i in self._used or interaction["transport"] != transport:
+                    continue
+                if interaction["method"] != method or interaction["url"] != url:
+                    continue
+                if interaction["request_hash"] == request_hash:
+                    self._used.add(i)
+                    return interaction
+                if fallback is None:
+                    fallback = i
+            if fallback is None:
+                raise CassetteMissError(f"No recorded response for {method} {url}")
+            if self.strict:
+                raise CassetteMissError(f"No recorded response for {method} {url} with this request body")
+            # Same endpoint with a different body, e.g. a prompt built from non-deterministic text
+            logging.warning(f"Replaying {method} {url} with a mismatched request body")
+            self._used.add(fallback)
+            return self.interactions[fallback]
+
+
+def _patch(target, name, replacement, patches):
+    patches.append((target, name, getattr(target, name)))
+    setattr(target, name, replacement)
+
+
+def _install_requests(cassette, mode, time_scale, patches):
+    try:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.structures import CaseInsensitiveDict
+    except ImportError:
+        return
+    original_send = HTTPAdapter.send
+
+    def send(self, request, **kwargs):
+        if mode == "replay":
+            interaction = cassette.next_response("requests", request.method, request.url, request.body)
+            time.sleep(interaction["elapsed"] * time_scale)
+            response = requests.Response()
+            response.status_code = interaction["status"]
+            response.headers = CaseInsensitiveDict(interaction["headers"])
+            response._content = _decode_body(interaction)
+            response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+            response.url = request.url
+            response.request = request
+            response.connection = self
+            return response
+        start = time.perf_counter()
+        response = original_send(self, request, **kwargs)
+        body = response.content
+        cassette.append("requests", request.method, request.url, request.body, response.status_code,
+                        response.headers.items(), body, time.perf_counter() - start)
+        return response
+
+    _patch(HTTPAdapter, "send", send, patches)
+
+
+def _install_httpx(cassette, mode, time_scale, patches):
+    try:
+        import httpx
+    except ImportError:
+        return
+    original_handle = httpx.HTTPTransport.handle_request
+
+    def handle_request(self, request):
+        request_body = request.read()
+        if mode == "replay":
+            interaction = cassette.next_response("httpx", request.method, str(request.url), request_body)
+            time.sleep(interaction["elapsed"] * time_scale)
+            return httpx.Response(interaction["status"], headers=interaction["headers"],
+                                  content=_decode_body(interaction), request=request)
+        start = time.perf_counter()
+        response = original_handle(self, request)
+        body = response.read()
+        response.close()
+        cassette.append("httpx", request.method, str(request.url), request_body, response.status_code,
+                        response.headers.items(), body, time.perf_counter() - start)
+        return httpx.Response(response.status_code, headers=_clean_headers(response.headers.items()),
+                              content=body, request=request)
+
+    _patch(httpx.HTTPTransport, "handle_request", handle_request, patches)
+
+
+def _install_urllib(cassette, mode, time_scale, patches):
+    # speech_recognition binds urlopen at import time, so patch the opener it ends up calling
+    original_open = urllib.request.OpenerDirector.open
+
+    def _response(body, headers, url, status):
+        message = Message()
+        for key, value in headers:
+            message[key] = value
+        return urllib.response.addinfourl(io.BytesIO(body), message, url, status)
+
+    def open_(self, fullurl, data=None, *args, **kwargs):
+        request = fullurl if isinstance(fullurl, urllib.request.Request) else urllib.request.Request(fullurl, data)
+        request_body = data if data is not None else request.data
+        method = request.get_method()
+        if mode == "replay":
+            interaction = cassette.next_response("urllib", method, request.full_url, request_body)
+            time.sleep(interaction["elapsed"] * time_scale)
+            return _response(_decode_body(interaction), interaction["headers"], request.full_url,
+                             interaction["status"])
+        start = time.perf_counter()
+        response = original_open(self, fullurl, data, *args, **kwargs)
+        body = response.read()
+        status = response.status
+        cassette.append("urllib", method, request.full_url, request_body, status,
+                        response.headers.items(), body, time.perf_counter() - start)
+        return _response(body, _clean_headers(response.headers.items()), request.full_url, status)
+
+    _patch(urllib.request.OpenerDirector, "open", open_, patches)
+
+
+def _scale_polling(time_scale, patches):
+    # The Text-to-CAD polling loop sleeps between checks; replay should compress that too
+    try:
+        utils = importlib.import_module("utils")
+    except Exception as e:
+        logging.warning(f"Could not import utils to scale its polling delays; replay will poll at full speed: {e}")
+        return
+    _patch(utils, "STATUS_CHECK_DELAY", utils.STATUS_CHECK_DELAY * time_scale, patches)
+    _patch(utils, "POLL_INTERVAL", utils.POLL_INTERVAL * time_scale, patches)
+
+
+@contextlib.contextmanager
+def _cassette_session(cassette, mode, time_scale):
+    patches = []
+    try:
+        _install_requests(cassette, mode, time_scale, patches)
+        _install_httpx(cassette, mode, time_scale, patches)
+        _install_urllib(cassette, mode, time_scale, patches)
+        if mode == "replay":
+            _scale_polling(time_scale, patches)
+        yield cassette
+    finally:
+        for target, name, original in reversed(patches):
+            setattr(target, name, original)
+
+
+@contextlib.contextmanager
+def record(path):
+    """
+    Records all external API traffic made inside the block to a cassette file.
+
+    Request headers (including API keys) are never written; requests are identified by
+    method, URL and a hash of the body.
+
+    :param path: Where to write the gzip-compressed cassette.
+    """
+    cassette = Cassette(path)
+    try:
+        with _cassette_session(cassette, "record", 1.0):
+            yield cassette
+    finally:
+        cassette.save()
+
+
+@contextlib.contextmanager
+def replay(path, time_scale=1.0, strict=False):
+    """
+    Serves external API traffic inside the block from a recorded cassette.
+
+    :param path: The cassette to replay.
+    :param time_scale: Multiplier on recorded latencies and polling delays; 1.0 reproduces the
+                       original timing, 0.0 removes it entirely.
+    :param strict: Raise CassetteMissError when a request's body doesn't match the recording,
+                   instead of serving the next response recorded for the same endpoint.
+    """
+    cassette = Cassette.load(path, strict=strict)
+    with _cassette_session(cassette, "replay", time_scale):
+        yield cassette
+
+
+def profile_pipeline(idea):
+    """
+    Runs the idea-to-STL pipeline once and returns wall-clock seconds per stage.
+    """
+    from utils import generate_formatted_instructions, generate_stl_model
+
+    timings = {}
+    start = time.perf_counter()
+    status, formatted_instructions = generate_formatted_instructions(idea)
+    timings["instructions"] = time.perf_counter() - start
+    if status:
+        start = time.perf_counter()
+        generate_stl_model(formatted_instructions)
+        timings["stl_model"] = time.perf_counter() - start
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record or replay external API traffic for a pipeline run.")
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("cassette", help="Path of the .jsonl.gz cassette")
+    parser.add_argument("idea", help="The idea to run through the pipeline")
+    parser.add_argument("--time-scale", type=float, default=0.0,
+                        help="Replay latency multiplier (1.0 = original timing, 0.0 = none)")
+    parser.add_argument("--strict", action="store_true",
+                        help="Fail on requests whose body differs from the recording")
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        with record(args.cassette):
+            timings = profile_pipeline(args.idea)
+    else:
+        import os
+        # Replay never reaches the real services, but utils refuses to import without a token
+        os.environ.setdefault("KITTYCAD_API_TOKEN", "replay")
+        os.environ.setdefault("OPENAI_API_KEY", "replay")
+        with replay(args.cassette, time_scale=args.time_scale, strict=args.strict):
+            timings = profile_pipeline(args.idea)
+
+    for stage, seconds in timings.items():
+        print(f"{stage}: {seconds:.3f}s")
@@ -2,16 +2,79 @@
 import streamlit as st
 import io
 import os
+import logging
 from pydub import AudioSegment
 import pyvista as pv
 from openai_vision import OpenAIVision
-from utils import provide_download_button, generate_formatted_instructions, generate_stl_model, speech_to_text, save_uploaded_file, visualize_stl
+from utils import provide_download_button, speech_to_text, analyze_uploaded_image, visualize_stl
+from jobs import submit_generation, submit_reuse
+from idea_index import get_idea_index
+from artifacts import load_artifact, EXPORT_FORMATS
+from thumbnails import request_thumbnails, is_rendering
+from openai_text import usage_tracker
+
+# Seconds between UI refreshes while a generation job or thumbnail render is running
+JOB_REFRESH_INTERVAL = 2
+GALLERY_PAGE_SIZE = 12
+GALLERY_COLUMNS = 4
+
+
+@st.fragment(run_every=JOB_REFRESH_INTERVAL)
+def show_job_progress(job):
+    """
+    Polls a running job from a fragment, so only this block refreshes while the job runs.
+    """
+    if job.done():
+        # Render the result with a single full rerun; the fragment is not shown after that
+        st.rerun()
+    if job.formatted_instructions:
+        st.write("Formatted instructions based on image analysis and description:", job.formatted_instructions)
+    st.info(f"{job.stage}... ({int(job.elapsed())}s elapsed)")
+
+
+def show_thumbnail_grid(items):
+    """
+    Shows a page of gallery items as thumbnails, queueing any that still need rendering.
+    """
+    thumbnails = request_thumbnails([artifact_id for *_, artifact_id in items])
+    columns = st.columns(GALLERY_COLUMNS)
+    for i, (entry_id, idea, file_name, artifact_id) in enumerate(items):
+        with columns[i % GALLERY_COLUMNS]:
+            if thumbnails[artifact_id]:
+                st.image(thumbnails[artifact_id])
+            elif is_rendering(artifact_id):
+                st.caption("Rendering preview...")
+            else:
+                st.caption("No preview available.")
+            st.caption(idea if len(idea) <= 80 else idea[:77] + "...")
+            if st.button("Open", key=f"gallery_open_{entry_id}_{artifact_id}"):
+                st.session_state["gallery_selected"] = (artifact_id, file_name)
+                # The viewer is outside this grid, which may be running as a fragment
+                st.rerun()
+
+
+@st.fragment(run_every=JOB_REFRESH_INTERVAL)
+def poll_thumbnail_grid(items):
+    """
+    Refreshes the thumbnail grid from a fragment while previews render, leaving the rest of the page alone.
+    """
+    if not any(is_rendering(artifact_id) for *_, artifact_id in items):
+        # Show the finished grid with a single full rerun, which stops the polling
+        st.rerun()
+    show_thumbnail_grid(items)
+
 
 class Almeche:
     def __init__(self):
         self.vision_model = OpenAIVision()
 
     def main(self):
+        view = st.sidebar.radio("View", ["Create", "Gallery"])
+        self.show_llm_usage()
+        if view == "Gallery":
+            self.show_gallery()
+            return
+
         st.title('Welcome to AlmechE')
         st.write("Transform your ideas into tangible 3D printed objects.")
 
@@ -39,28 +102,131 @@ class Almeche:
             uploaded_image = st.file_uploader("Upload an image", type=['jpg', 'jpeg', 'png'])
             if uploaded_image is not None:
                 st.image(uploaded_image, caption='Uploaded Image.', use_column_width=True)
-                temp_image_path = save_uploaded_file(uploaded_image)
-                if temp_image_path:
-                    image_analysis = self.vision_model.analyze_image(temp_image_path)
+                # Reruns (including job progress refreshes) must not re-analyze the same upload
+                upload_key = f"{uploaded_image.name}:{uploaded_image.size}"
+                if st.session_state.get("image_analysis_key") == upload_key:
+                    image_analysis = st.session_state["image_analysis"]
+                else:
+                    # Failures are reported by analyze_uploaded_image and retried on the next rerun
+                    image_analysis = analyze_uploaded_image(self.vision_model, uploaded_image)
+                    if image_analysis is not None:
+                        st.session_state["image_analysis"] = image_analysis
+                        st.session_state["image_analysis_key"] = upload_key
+                if image_analysis is not None:
                     st.write("Image analysis:", image_analysis)
                     additional_description = st.text_input("How're we using this image to make a 3D object? Please describe.")
-                    os.remove(temp_image_path)  # Clean up the temporary file
-            
-                    if st.button("Generate 3D Model with Image"):
-                        combined_idea = f"{image_analysis} - {additional_description}"
-                        status, formatted_instructions = generate_formatted_instructions(combined_idea)
-                        if status:
-                            st.write("Formatted instructions based on image analysis and description:", formatted_instructions)
-                            status, stl_files = generate_stl_model(formatted_instructions)
-                            if status == "Completed":
-                                st.success("Model generated successfully.")
-                                for file_name, stl_data_bytes in stl_files.items():
-                                    provide_download_button(stl_data_bytes, file_name)
-                                    visualize_stl(stl_data_bytes)
-                            else:
-                                st.error("An error occurred: " + stl_files)
-                        else:
-                            st.error(formatted_instructions)
+
+                    combined_idea = f"{image_analysis} - {additional_description}"
+                    job_running = self.job_running()
+                    self.suggest_similar_model(combined_idea, additional_description, image_analysis,
+                                               disabled=job_running)
+
+                    # A second job would orphan the running one while it still holds a pool worker
+                    if st.button("Generate 3D Model with Image", disabled=job_running):
+                        st.session_state["generation_job"] = submit_generation(
+                            combined_idea, description=additional_description, context=image_analysis)
+
+        job = st.session_state.get("generation_job")
+        if job is not None:
+            self.show_generation_job(job)
+
+    def job_running(self):
+        job = st.session_state.get("generation_job")
+        return job is not None and not job.done()
+
+    def suggest_similar_model(self, idea, description, context, disabled=False):
+        """
+        Offers a previously generated model when the request resembles one, but not closely enough to reuse automatically.
+        """
+        try:
+            match = get_idea_index().find_similar(description, context=context)
+        except Exception as e:
+            logging.exception(f"Idea index lookup failed: {e}")
+            return
+        if match is None or match.auto_reusable():
+            return
+        st.info(f"A similar model was generated before ({match.score:.0%} match): {match.idea}")
+        if st.button("Use existing model", disabled=disabled):
+            st.session_state["generation_job"] = submit_reuse(idea, match, description=description, context=context)
+
+    def show_generation_job(self, job):
+        """
+        Renders the progress or result of a background generation job.
+        """
+        if not job.done():
+            show_job_progress(job)
+            return
+
+        if job.formatted_instructions:
+            st.write("Formatted instructions based on image analysis and description:", job.formatted_instructions)
+        if job.succeeded():
+            if job.reused_from:
+                st.success(f"Reused a model generated for: {job.reused_from.idea}")
+            else:
+                st.success("Model generated successfully.")
+            for file_name, stl_data_bytes in job.stl_files.items():
+                provide_download_button(stl_data_bytes, file_name)
+                visualize_stl(stl_data_bytes)
+        else:
+            st.error("An error occurred: " + str(job.error))
+
+    def show_llm_usage(self):
+        """
+        Shows per-stage LLM spend and latency for this server process in the sidebar.
+        """
+        report = usage_tracker.report()
+        if not report:
+            return
+        with st.sidebar.expander("LLM usage"):
+            for stage, totals in report.items():
+                st.write(f"**{stage}**: {totals['calls']} calls ({totals['errors']} failed), "
+                         f"{totals['prompt_tokens'] + totals['completion_tokens']} tokens, ${totals['cost_usd']:.4f}")
+                for model, latency in totals["models"].items():
+                    st.caption(f"{model}: p50 {latency['p50']:.1f}s, p95 {latency['p95']:.1f}s ({latency['samples']} samples)")
+
+    def show_gallery(self):
+        """
+        Shows past models a page at a time as cached thumbnails, opening the interactive viewer only on request.
+        """
+        st.title('Model Gallery')
+        index = get_idea_index()
+        total = index.count_entries()
+        if not total:
+            st.write("No models have been generated yet.")
+            return
+
+        pages = (total + GALLERY_PAGE_SIZE - 1) // GALLERY_PAGE_SIZE
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, step=1)
+        entries = index.list_entries(offset=(page - 1) * GALLERY_PAGE_SIZE, limit=GALLERY_PAGE_SIZE)
+        items = [(entry_id, idea, file_name, artifact_id)
+                 for entry_id, idea, artifacts, _ in entries
+                 for file_name, artifact_id in artifacts.items()]
+
+        # Only thumbnails for the page in view are loaded or queued for rendering
+        request_thumbnails([artifact_id for *_, artifact_id in items])
+        if any(is_rendering(artifact_id) for *_, artifact_id in items):
+            poll_thumbnail_grid(items)
+        else:
+            show_thumbnail_grid(items)
+
+        selected = st.session_state.get("gallery_selected")
+        if selected:
+            artifact_id, file_name = selected
+            if st.button("Close"):
+                del st.session_state["gallery_selected"]
+                st.rerun()
+            stl_data_bytes = load_artifact(artifact_id)
+            if stl_data_bytes:
+                visualize_stl(stl_data_bytes)
+                # Other formats are only converted once someone asks for them
+                export_format = st.selectbox("Export format", EXPORT_FORMATS)
+                if export_format == "stl":
+                    provide_download_button(stl_data_bytes, file_name)
+                else:
+                    st.download_button(label=f"Download {export_format.upper()}",
+                                       data=load_artifact(artifact_id, export_format),
+                                       file_name=f"{os.path.splitext(file_name)[0]}.{export_format}",
+                                       mime="application/octet-stream")
 
 if __name__ == "__main__":
     Almeche().main()
@@ -0,0 +1,234 @@
+import os
+import io
+import re
+import json
+import struct
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+from config import DATA_DIR
+
+# Generated models are stored once per mesh hash under DATA_DIR. Each model is kept only in a
+# canonical indexed form (welded float32 vertices plus the narrowest integer face indices),
+# which is several times smaller than a triangle-soup STL and can be memory-mapped.
+# Export formats are built from it in memory on request; ARTIFACT_DIR only holds files
+# that have no canonical form (non-STL uploads).
+ARTIFACT_DIR = os.path.join(DATA_DIR, "artifacts")
+MESH_DIR = os.path.join(DATA_DIR, "meshes")
+
+EXPORT_FORMATS = ("stl", "obj", "glb")
+# Recently built exports are kept in memory up to this many bytes in total
+EXPORT_CACHE_BYTES = int(os.getenv("ALMECHE_EXPORT_CACHE_BYTES", str(128 * 1024 * 1024)))
+
+_export_cache = OrderedDict()
+_export_cache_size = 0
+_export_cache_lock = threading.Lock()
+
+_STL_TRIANGLE = np.dtype([("normal", "<f4", 3), ("vertices", "<f4", (3, 3)), ("attributes", "<u2")])
+_FLOAT_RE = rb"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+_ASCII_VERTEX_RE = re.compile(rb"vertex\s+(" + _FLOAT_RE + rb")\s+(" + _FLOAT_RE + rb")\s+(" + _FLOAT_RE + rb")")
+
+
+def _shard(directory, artifact_id):
+    # Shard by hash prefix so no single directory grows to thousands of entries
+    return os.path.join(directory, artifact_id[:2], artifact_id)
+
+
+def export_path(artifact_id, extension="stl"):
+    return f"{_shard(ARTIFACT_DIR, artifact_id)}.{extension}"
+
+
+def _mesh_paths(artifact_id):
+    base = _shard(MESH_DIR, artifact_id)
+    return f"{base}.vertices.npy", f"{base}.faces.npy"
+
+
+def _atomic_write(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def parse_stl(data):
+    """
+    Parses binary or ASCII STL data into an indexed mesh, welding duplicate vertices.
+
+    :param data: The STL file content as a bytes-like object.
+    :return: A tuple of (vertices float32 array of shape (n, 3), faces integer array of shape (m, 3)).
+    """
+    view = memoryview(data)
+    triangle_count = struct.unpack_from("<I", view, 80)[0] if len(view) >= 84 else -1
+    if len(view) == 84 + triangle_count * _STL_TRIANGLE.itemsize:
+        triangles = np.frombuffer(view, dtype=_STL_TRIANGLE, count=triangle_count, offset=84)
+        soup = triangles["vertices"].reshape(-1, 3)
+    elif bytes(view[:5]).lower() == b"solid":
+        soup = np.array(_ASCII_VERTEX_RE.findall(bytes(view)), dtype=np.float32).reshape(-1, 3)
+        if len(soup) % 3:
+            raise ValueError("ASCII STL has an incomplete facet.")
+    else:
+        raise ValueError("Data is not a valid STL file.")
+
+    vertices, inverse = np.unique(soup, axis=0, return_inverse=True)
+    index_dtype = np.uint16 if len(vertices) <= np.iinfo(np.uint16).max else np.uint32
+    faces = inverse.reshape(-1, 3).astype(index_dtype)
+    return np.ascontiguousarray(vertices, dtype=np.float32), faces
+
+
+def save_artifact(data, extension="stl"):
+    """
+    Stores a generated model once in canonical indexed form.
+
+    :param data: The model file content as a bytes-like object.
+    :param extension: The format of `data`. Only STL is canonicalized; other formats are stored as-is.
+    :return: The artifact ID (hex SHA-256 of the canonical mesh, or of the raw content for other formats).
+    """
+    if extension != "stl":
+        artifact_id = hashlib.sha256(data).hexdigest()
+        path = export_path(artifact_id, extension)
+        if not os.path.exists(path):
+            _atomic_write(path, lambda f: f.write(data))
+        return artifact_id
+
+    vertices, faces = parse_stl(data)
+    digest = hashlib.sha256(vertices.tobytes())
+    digest.update(faces.astype(np.uint32).tobytes())
+    artifact_id = digest.hexdigest()
+    vertices_path, faces_path = _mesh_paths(artifact_id)
+    if not os.path.exists(faces_path):
+        _atomic_write(vertices_path, lambda f: np.save(f, vertices))
+        _atomic_write(faces_path, lambda f: np.save(f, faces))
+        logging.info(f"Artifact saved: {artifact_id} ({len(vertices)} vertices, {len(faces)} faces, "
+                     f"{len(data)} STL bytes)")
+    return artifact_id
+
+
+def load_mesh(artifact_id):
+    """
+    Memory-maps a stored mesh for fast preview or slicing.
+
+    :return: A tuple of read-only (vertices, faces) arrays, or None if the artifact is not stored.
+    """
+    vertices_path, faces_path = _mesh_paths(artifact_id)
+    # The faces file is written last, so its presence means the mesh is complete
+    if not os.path.exists(faces_path):
+        logging.error(f"Artifact not found: {artifact_id}")
+        return None
+    return np.load(vertices_path, mmap_mode="r"), np.load(faces_path, mmap_mode="r")
+
+
+def _write_stl(f, vertices, faces):
+    # Fill the triangles straight into the output buffer instead of building and copying an array
+    output = bytearray(84 + len(faces) * _STL_TRIANGLE.itemsize)
+    output[:80] = b"AlmechE".ljust(80, b" ")
+    struct.pack_into("<I", output, 80, len(faces))
+    triangles = np.frombuffer(output, dtype=_STL_TRIANGLE, offset=84)
+    corners = vertices[faces]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, lengths, out=normals, where=lengths > 0)
+    triangles["normal"] = normals
+    triangles["vertices"] = corners
+    f.write(output)
+
+
+def _write_obj(f, vertices, faces):
+    text = io.TextIOWrapper(f, encoding="ascii", newline="\n")
+    np.savetxt(text, vertices, fmt="v %.9g %.9g %.9g")
+    np.savetxt(text, faces.astype(np.int64) + 1, fmt="f %d %d %d")
+    text.flush()
+    text.detach()
+
+
+def _write_glb(f, vertices, faces):
+    positions = np.ascontiguousarray(vertices, dtype=np.float32).tobytes()
+    indices = np.ascontiguousarray(faces, dtype=np.uint32).tobytes()
+    binary = positions + indices
+    gltf = {
+        "asset": {"version": "2.0", "generator": "AlmechE"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [{"attributes": {"POSITION": 0}, "indices": 1}]}],
+        "buffers": [{"byteLength": len(binary)}],
+        "bufferViews": [
+            {"buffer": 0, "byteOffset": 0, "byteLength": len(positions), "target": 34962},
+            {"buffer": 0, "byteOffset": len(positions), "byteLength": len(indices), "target": 34963},
+        ],
+        "accessors": [
+            {"bufferView": 0, "componentType": 5126, "count": len(vertices), "type": "VEC3",
+             "min": vertices.min(axis=0).tolist() if len(vertices) else [0, 0, 0],
+             "max": vertices.max(axis=0).tolist() if len(vertices) else [0, 0, 0]},
+            {"bufferView": 1, "componentType": 5125, "count": faces.size, "type": "SCALAR"},
+        ],
+    }
+    json_chunk = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    binary += b"\0" * (-len(binary) % 4)
+    f.write(struct.pack("<III", 0x46546C67, 2, 12 + 8 + len(json_chunk) + 8 + len(binary)))
+    f.write(struct.pack("<II", len(json_chunk), 0x4E4F534A))
+    f.write(json_chunk)
+    f.write(struct.pack("<II", len(binary), 0x004E4942))
+    f.write(binary)
+
+
+_EXPORTERS = {"stl": _write_stl, "obj": _write_obj, "glb": _write_glb}
+
+
+def _cache_export(key, data):
+    global _export_cache_size
+    if len(data) > EXPORT_CACHE_BYTES:
+        return
+    with _export_cache_lock:
+        if key in _export_cache:
+            return
+        _export_cache[key] = data
+        _export_cache_size += len(data)
+        while _export_cache_size > EXPORT_CACHE_BYTES:
+            _, evicted = _export_cache.popitem(last=False)
+            _export_cache_size -= len(evicted)
+
+
+def _cached_export(key):
+    with _export_cache_lock:
+        data = _export_cache.get(key)
+        if data is not None:
+            _export_cache.move_to_end(key)
+        return data
+
+
+def load_artifact(artifact_id, extension="stl"):
+    """
+    Loads a stored artifact in the given format, building it in memory from the canonical mesh.
+
+    Built exports are kept in a bounded in-memory cache; nothing is written back to disk.
+
+    :param artifact_id: The stored artifact.
+    :param extension: One of EXPORT_FORMATS, or the format a non-STL artifact was saved in.
+    :return: The file content as bytes, or None if it is not stored.
+    """
+    key = (artifact_id, extension)
+    data = _cached_export(key)
+    if data is not None:
+        return data
+
+    raw_path = export_path(artifact_id, extension)
+    if extension != "stl" and os.path.exists(raw_path):
+        # Saved as-is because it had no canonical form
+        with open(raw_path, "rb") as f:
+            return f.read()
+    if extension not in _EXPORTERS:
+        raise ValueError(f"Unsupported export format: {extension}")
+
+    mesh = load_mesh(artifact_id)
+    if mesh is None:
+        return None
+    vertices, faces = mesh
+    output = io.BytesIO()
+    _EXPORTERS[extension](output, vertices, faces)
+    data = output.getvalue()
+    _cache_export(key, data)
+    return data
@@ -0,0 +1,4 @@
+import os
+
+# Root directory for everything AlmechE persists: artifacts, the idea index, thumbnails and usage logs
+DATA_DIR = os.getenv("ALMECHE_DATA_DIR", "almeche_data")
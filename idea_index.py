@@ -0,0 +1,342 @@
+import os
+import re
+import json
+import time
+import random
+import struct
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+from array import array
+from config import DATA_DIR
+
+INDEX_PATH = os.path.join(DATA_DIR, "idea_index.sqlite3")
+
+# MinHash signature length and LSH banding; 16 bands of 4 rows make a pair with
+# Jaccard similarity 0.7 a candidate ~99% of the time and one at 0.3 only ~12%.
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // NUM_BANDS
+
+# Scores at or above SUGGEST_THRESHOLD are offered to the user; at or above
+# AUTO_REUSE_THRESHOLD the earlier model is reused without asking.
+SUGGEST_THRESHOLD = 0.6
+AUTO_REUSE_THRESHOLD = 0.85
+# Minimum similarity between the image analyses of two photo-based requests for them to
+# be considered the same object at all
+CONTEXT_MATCH_THRESHOLD = 0.6
+# Score multiplier when only one of the two texts states dimensions
+UNMATCHED_DIMENSIONS_PENALTY = 0.85
+MAX_CANDIDATES = 200
+
+# What the user asked for, the formatted instructions, and the context the request was made
+# in (currently an image analysis). Scored separately so a long shared context such as the
+# analysis of the same photo cannot outweigh a different request.
+KINDS = ("description", "instructions", "context")
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(0x414C4D)  # Fixed seed: signatures must be stable across runs
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+                 for _ in range(NUM_PERMUTATIONS)]
+
+_STOPWORDS = {
+    "a", "an", "the", "for", "with", "of", "to", "and", "or", "that", "this", "my", "i", "me",
+    "want", "need", "make", "create", "design", "please", "some", "which", "is", "at", "in", "on",
+    "it", "its", "using", "use", "we", "are",
+}
+_SYNONYMS = {
+    "holder": "stand", "dock": "stand", "cradle": "stand",
+    "box": "case", "enclosure": "case", "container": "case",
+    "cellphone": "phone", "smartphone": "phone", "mobile": "phone",
+    "degree": "deg", "degrees": "deg",
+}
+_UNIT_TO_MM = {"mm": 1.0, "cm": 10.0, "in": 25.4}
+_DIMENSION_RE = re.compile(
+    r"(\d+(?:\.\d+)?)\s*(mm|millimet(?:er|re)s?|cm|centimet(?:er|re)s?|inch(?:es)?|\"|°|deg(?:ree)?s?\b)"
+)
+
+
+def normalize_text(text):
+    """
+    Lowercases and tokenizes text, folding units, common synonyms and plurals so paraphrases share tokens.
+    """
+    text = unicodedata.normalize("NFKC", text).lower().replace("°", " deg ")
+    tokens = []
+    for token in re.findall(r"[a-z]+|\d+(?:\.\d+)?", text):
+        if token in _STOPWORDS:
+            continue
+        token = _SYNONYMS.get(token, token)
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = _SYNONYMS.get(token[:-1], token[:-1])
+        tokens.append(token)
+    return tokens
+
+
+def extract_dimensions(text):
+    """
+    Extracts stated dimensions, converted to millimetres or degrees.
+
+    :return: A sorted tuple of (value, unit) pairs with unit "mm" or "deg".
+    """
+    dimensions = set()
+    for value, unit in _DIMENSION_RE.findall(unicodedata.normalize("NFKC", text).lower()):
+        value = float(value)
+        if unit in ("°",) or unit.startswith("deg"):
+            dimensions.add((round(value, 1), "deg"))
+            continue
+        if unit.startswith("milli"):
+            unit = "mm"
+        elif unit.startswith("centi"):
+            unit = "cm"
+        elif unit.startswith("in") or unit == '"':
+            unit = "in"
+        dimensions.add((round(value * _UNIT_TO_MM[unit], 1), "mm"))
+    return tuple(sorted(dimensions))
+
+
+def _feature_hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def minhash_signature(tokens):
+    """
+    Computes the MinHash signature of a token set.
+    """
+    hashes = [_feature_hash(token) for token in set(tokens)] or [0]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def _band_buckets(signature, kind):
+    # Band numbers are offset per kind so signatures of different kinds never collide
+    offset = KINDS.index(kind) * NUM_BANDS
+    buckets = []
+    for band in range(NUM_BANDS):
+        rows = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        digest = hashlib.blake2b(struct.pack(f"<{ROWS_PER_BAND}Q", *rows), digest_size=8).digest()
+        buckets.append((offset + band, int.from_bytes(digest, "little", signed=True)))
+    return buckets
+
+
+def _signature_similarity(signature, other_signature):
+    return sum(1 for x, y in zip(signature, other_signature) if x == y) / NUM_PERMUTATIONS
+
+
+def _similarity(signature, other_signature, dimensions, other_dimensions):
+    score = _signature_similarity(signature, other_signature)
+    if dimensions and other_dimensions:
+        # Same object at a different size is a different model
+        return score if dimensions == other_dimensions else 0.0
+    if dimensions or other_dimensions:
+        return score * UNMATCHED_DIMENSIONS_PENALTY
+    return score
+
+
+def _pack(signature):
+    return array("Q", signature).tobytes() if signature else None
+
+
+class IdeaMatch:
+    """
+    A previously generated model whose idea or instructions resemble a new request.
+
+    `suggest_only` marks matches that may be offered to the user but never reused
+    automatically, e.g. when only the photo matched and not what was asked for.
+    """
+
+    def __init__(self, entry_id, score, idea, formatted_instructions, artifacts, suggest_only=False):
+        self.entry_id = entry_id
+        self.score = score
+        self.idea = idea
+        self.formatted_instructions = formatted_instructions
+        self.artifacts = artifacts  # File name -> artifact ID
+        self.suggest_only = suggest_only
+
+    def auto_reusable(self):
+        return self.score >= AUTO_REUSE_THRESHOLD and not self.suggest_only
+
+
+class IdeaIndex:
+    """
+    Local MinHash/LSH index over past requests and formatted instructions, persisted in SQLite.
+
+    Lookups only touch entries sharing at least one LSH bucket with the query, so they
+    stay fast with hundreds of thousands of stored jobs.
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connection() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    id INTEGER PRIMARY KEY,
+                    idea TEXT NOT NULL,
+                    formatted_instructions TEXT,
+                    description TEXT,
+                    description_signature BLOB NOT NULL,
+                    description_dimensions TEXT NOT NULL,
+                    context TEXT,
+                    context_signature BLOB,
+                    instructions_signature BLOB,
+                    instructions_dimensions TEXT,
+                    artifacts TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS buckets (
+                    band INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    entry_id INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS buckets_lookup ON buckets (band, bucket);
+            """)
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads, and jobs run on a worker pool
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, idea, formatted_instructions, artifacts, description=None, context=""):
+        """
+        Records a completed job.
+
+        :param idea: The full idea text the model was generated from.
+        :param formatted_instructions: The instructions sent to Text-to-CAD.
+        :param artifacts: A dict mapping output file names to artifact IDs.
+        :param description: What the user asked for in their own words; defaults to `idea`.
+        :param context: Text the request was made about, such as an image analysis.
+        :return: The new entry's ID.
+        """
+        description = idea if description is None else description
+        description_tokens = normalize_text(description)
+        context_tokens = normalize_text(context or "")
+        description_signature = minhash_signature(description_tokens)
+        context_signature = minhash_signature(context_tokens) if context_tokens else None
+        instructions_signature = minhash_signature(normalize_text(formatted_instructions or ""))
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "INSERT INTO entries (idea, formatted_instructions, description, description_signature,"
+                " description_dimensions, context, context_signature, instructions_signature,"
+                " instructions_dimensions, artifacts, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (idea, formatted_instructions, description,
+                 _pack(description_signature), json.dumps(extract_dimensions(description)),
+                 context, _pack(context_signature), _pack(instructions_signature),
+                 json.dumps(extract_dimensions(formatted_instructions or "")),
+                 json.dumps(artifacts), time.time()),
+            )
+            entry_id = cursor.lastrowid
+            rows = []
+            if description_tokens:
+                rows += _band_buckets(description_signature, "description")
+            if context_signature:
+                rows += _band_buckets(context_signature, "context")
+            if formatted_instructions:
+                rows += _band_buckets(instructions_signature, "instructions")
+            conn.executemany("INSERT INTO buckets (band, bucket, entry_id) VALUES (?, ?, ?)",
+                             [(band, bucket, entry_id) for band, bucket in rows])
+        return entry_id
+
+    def _candidates(self, buckets):
+        where = " OR ".join(["(band = ? AND bucket = ?)"] * len(buckets))
+        return [row[0] for row in self._connection().execute(
+            f"SELECT entry_id FROM buckets WHERE {where}"
+            " GROUP BY entry_id ORDER BY COUNT(*) DESC LIMIT ?",
+            [value for pair in buckets for value in pair] + [MAX_CANDIDATES],
+        )]
+
+    def find_similar(self, text, kind="description", context=""):
+        """
+        Finds the most similar earlier job.
+
+        For descriptions, the request and its context are compared separately: the context
+        (e.g. the photo) must match for a request made about one, and a match on context alone,
+        when no request text was given, is only ever suggested.
+
+        :param text: The user's request, or formatted instructions when `kind` is "instructions".
+        :param kind: "description" or "instructions", selecting which stored text to compare against.
+        :param context: Text the request was made about, such as an image analysis.
+        :return: The best IdeaMatch scoring at least SUGGEST_THRESHOLD, or None.
+        """
+        tokens = normalize_text(text)
+        context_tokens = normalize_text(context or "") if kind == "description" else []
+        context_signature = minhash_signature(context_tokens) if context_tokens else None
+        if tokens:
+            signature = minhash_signature(tokens)
+            candidate_ids = self._candidates(_band_buckets(signature, kind))
+        elif context_signature:
+            candidate_ids = self._candidates(_band_buckets(context_signature, "context"))
+        else:
+            return None
+        if not candidate_ids:
+            return None
+
+        dimensions = extract_dimensions(text)
+        signature_column = "description" if kind == "description" else "instructions"
+        best = None
+        placeholders = ",".join("?" * len(candidate_ids))
+        for row in self._connection().execute(
+            f"SELECT id, idea, formatted_instructions, {signature_column}_signature,"
+            f" {signature_column}_dimensions, context_signature, artifacts"
+            f" FROM entries WHERE id IN ({placeholders})", candidate_ids,
+        ):
+            entry_id, idea, formatted_instructions, stored_signature, stored_dimensions, \
+                stored_context_signature, artifacts = row
+            suggest_only = False
+            if kind == "description" and (context_signature or stored_context_signature):
+                if not (context_signature and stored_context_signature):
+                    # One request was about a photo and the other wasn't
+                    suggest_only = True
+                    context_score = 1.0
+                else:
+                    context_score = _signature_similarity(context_signature, array("Q", stored_context_signature))
+                if context_score < CONTEXT_MATCH_THRESHOLD:
+                    continue
+            if tokens:
+                score = _similarity(signature, array("Q", stored_signature), dimensions,
+                                    tuple(tuple(d) for d in json.loads(stored_dimensions)))
+            else:
+                # Nothing was asked beyond the photo itself, so only the photo can be compared
+                score, suggest_only = context_score, True
+            if score >= SUGGEST_THRESHOLD and (best is None or score > best.score):
+                best = IdeaMatch(entry_id, score, idea, formatted_instructions, json.loads(artifacts), suggest_only)
+        if best:
+            logging.info(f"Found similar {kind} (entry {best.entry_id}, score {best.score:.2f},"
+                         f" suggest only: {best.suggest_only})")
+        return best
+
+    def count_entries(self):
+        return self._connection().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def list_entries(self, offset=0, limit=20):
+        """
+        Lists recorded jobs, newest first.
+
+        :return: A list of (entry ID, idea, artifacts dict, created_at) tuples.
+        """
+        rows = self._connection().execute(
+            "SELECT id, idea, artifacts, created_at FROM entries ORDER BY id DESC LIMIT ? OFFSET ?",
+            (limit, offset),
+        )
+        return [(entry_id, idea, json.loads(artifacts), created_at) for entry_id, idea, artifacts, created_at in rows]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_idea_index():
+    """
+    Returns the process-wide idea index, opening it on first use.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = IdeaIndex()
+        return _index
@@ -0,0 +1,177 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import generate_formatted_instructions, generate_stl_model
+from artifacts import save_artifact, load_artifact
+from idea_index import get_idea_index
+from thumbnails import request_thumbnails
+
+# Upper bound on generation jobs running at once across every Streamlit session
+MAX_WORKERS = int(os.getenv("ALMECHE_MAX_WORKERS", "4"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the process-wide worker pool, creating it on first use.
+
+    Streamlit reruns scripts but imports modules once per process, so every
+    session shares this pool.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="almeche-job")
+        return _executor
+
+
+class GenerationJob:
+    """
+    Handle for an idea-to-STL job running on the shared worker pool.
+
+    The worker thread updates `stage` as it goes; the UI only reads it.
+    """
+
+    def __init__(self, idea, description=None, context=""):
+        self.id = uuid.uuid4().hex
+        self.idea = idea
+        self.description = idea if description is None else description  # The user's own request
+        self.context = context  # What the request is about, e.g. an image analysis
+        self.stage = "Queued"
+        self.formatted_instructions = None
+        self.stl_files = None
+        self.reused_from = None  # IdeaMatch when an earlier model was reused
+        self.error = None
+        self.submitted_at = time.time()
+        self.future = None
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def succeeded(self):
+        return self.done() and self.error is None and self.stl_files is not None
+
+    def elapsed(self):
+        return time.time() - self.submitted_at
+
+
+def _reuse_match(job, match):
+    stl_files = {}
+    for file_name, artifact_id in match.artifacts.items():
+        data = load_artifact(artifact_id)
+        if data is None:
+            return False
+        stl_files[file_name] = data
+    if not stl_files:
+        return False
+    job.formatted_instructions = match.formatted_instructions
+    job.stl_files = stl_files
+    job.reused_from = match
+    job.stage = "Completed"
+    logging.info(f"Generation job {job.id} reused entry {match.entry_id} (score {match.score:.2f})")
+    return True
+
+
+def _find_reusable(text, kind, context=""):
+    try:
+        match = get_idea_index().find_similar(text, kind=kind, context=context)
+        return match if match and match.auto_reusable() else None
+    except Exception as e:
+        logging.exception(f"Idea index lookup failed: {e}")
+        return None
+
+
+def _record_generation(job):
+    try:
+        artifacts = {file_name: save_artifact(data) for file_name, data in job.stl_files.items()}
+        get_idea_index().add(job.idea, job.formatted_instructions, artifacts,
+                             description=job.description, context=job.context)
+        request_thumbnails(artifacts.values())
+    except Exception as e:
+        logging.exception(f"Failed to record generation job {job.id}: {e}")
+
+
+def _run_generation(job, reuse_existing):
+    try:
+        if reuse_existing:
+            job.stage = "Looking for similar models"
+            match = _find_reusable(job.description, "description", context=job.context)
+            if match and _reuse_match(job, match):
+                return
+
+        job.stage = "Generating manufacturing instructions"
+        status, formatted_instructions = generate_formatted_instructions(job.idea)
+        if not status:
+            job.error = formatted_instructions
+            job.stage = "Failed"
+            return
+        job.formatted_instructions = formatted_instructions
+
+        if reuse_existing:
+            match = _find_reusable(formatted_instructions, "instructions")
+            if match and _reuse_match(job, match):
+                return
+
+        job.stage = "Submitting to Text-to-CAD"
+
+        def on_status(model_status):
+            job.stage = f"Generating model ({model_status})"
+
+        status, stl_files = generate_stl_model(formatted_instructions, on_status=on_status)
+        if status == "Completed":
+            job.stl_files = stl_files
+            _record_generation(job)
+            job.stage = "Completed"
+        else:
+            job.error = stl_files
+            job.stage = status
+    except Exception as e:
+        logging.exception(f"Generation job {job.id} failed: {e}")
+        job.error = "An unexpected error occurred during the process."
+        job.stage = "Error"
+
+
+def _run_reuse(job, match):
+    try:
+        job.stage = "Loading existing model"
+        if not _reuse_match(job, match):
+            job.error = "The existing model could not be loaded."
+            job.stage = "Failed"
+    except Exception as e:
+        logging.exception(f"Reuse job {job.id} failed: {e}")
+        job.error = "An unexpected error occurred while loading the existing model."
+        job.stage = "Error"
+
+
+def submit_generation(idea, reuse_existing=True, description=None, context=""):
+    """
+    Queues a generation job on the shared worker pool.
+
+    :param idea: The combined idea text to turn into a model.
+    :param reuse_existing: Reuse an earlier model instead of generating when a near-duplicate request is indexed.
+    :param description: What the user asked for in their own words; defaults to `idea`.
+    :param context: Text the request is about, such as an image analysis, matched separately from `description`.
+    :return: A GenerationJob handle suitable for keeping in st.session_state.
+    """
+    job = GenerationJob(idea, description, context)
+    job.future = get_executor().submit(_run_generation, job, reuse_existing)
+    logging.info(f"Generation job {job.id} submitted.")
+    return job
+
+
+def submit_reuse(idea, match, description=None, context=""):
+    """
+    Queues a job that loads the model from an earlier, similar idea instead of generating one.
+
+    :param idea: The new idea text.
+    :param match: The IdeaMatch the user chose to reuse.
+    :return: A GenerationJob handle.
+    """
+    job = GenerationJob(idea, description, context)
+    job.future = get_executor().submit(_run_reuse, job, match)
+    return job
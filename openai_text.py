@@ -1,32 +1,221 @@
 import openai
 import os
+import json
+import math
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+from config import DATA_DIR
 
 # Ensure your OPENAI_API_KEY is set in your environment variables
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-def generate_ai_text(prompt: str, temperature: float) -> str:
+USAGE_LOG_PATH = os.path.join(DATA_DIR, "llm_usage.jsonl")
+# Number of recent calls per stage and model kept for latency reporting
+LATENCY_WINDOW = 200
+# Routing only looks at calls from the last few minutes, so a past slow spell ages out
+ROUTING_WINDOW_SECONDS = 300
+# Minimum recent samples before observed latency is trusted for routing; with nearest-rank
+# p95 a single slow call among this many is not enough to switch models
+MIN_ROUTING_SAMPLES = 20
+# While a stage is routed to its fast model, every Nth call still goes to the primary
+# model, and the stage switches back once this many probes in a row are within budget.
+PRIMARY_PROBE_INTERVAL = 10
+MIN_PROBE_SAMPLES = 3
+
+TEXT_ERROR = "Error generating text."
+
+# USD per 1K (prompt, completion) tokens
+MODEL_PRICES = {
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-3.5-turbo-1106": (0.001, 0.002),
+}
+
+
+class RequestProfile:
+    """
+    Model and request settings for one pipeline stage.
+
+    When `fast_model` and `p95_latency_budget` are set, calls are routed to the fast model
+    while the primary model's observed p95 latency for the stage exceeds the budget.
+    """
+
+    def __init__(self, model, max_tokens, temperature, timeout, fast_model=None, p95_latency_budget=None):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.timeout = timeout
+        self.fast_model = fast_model
+        self.p95_latency_budget = p95_latency_budget
+
+
+# max_tokens leave headroom over the word limits in cad_prompts
+STAGE_PROFILES = {
+    "idea": RequestProfile("gpt-4-1106-preview", max_tokens=60, temperature=0.8, timeout=30,
+                           fast_model="gpt-3.5-turbo-1106", p95_latency_budget=8),
+    "manufacturing_instructions": RequestProfile("gpt-4-1106-preview", max_tokens=250, temperature=0.808, timeout=60),
+    "formatted_instructions": RequestProfile("gpt-4-1106-preview", max_tokens=200, temperature=0.808, timeout=45,
+                                             fast_model="gpt-3.5-turbo-1106", p95_latency_budget=15),
+    "default": RequestProfile("gpt-4-1106-preview", max_tokens=3000, temperature=0.7, timeout=120),
+}
+
+
+def _percentile(values, fraction):
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class UsageTracker:
+    """
+    Records token usage, cost and latency per stage, and keeps recent latencies for routing.
     """
-    Generates text based on the provided prompt using OpenAI's GPT-4 preview model.
-    
+
+    def __init__(self, log_path=USAGE_LOG_PATH):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        # (stage, model) -> (monotonic time, seconds) of recent calls
+        self._latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self._totals = defaultdict(lambda: defaultdict(float))  # stage -> counters
+        self._routed_calls = defaultdict(int)
+        self._routed_since = {}  # stage -> monotonic time it switched to its fast model
+        self._unrouted_since = {}  # stage -> monotonic time it last switched back
+
+    def record(self, stage, model, latency, prompt_tokens=0, completion_tokens=0, error=False):
+        prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+        with self._lock:
+            # Failed calls count too: timeouts are exactly the latency routing should react to
+            self._latencies[(stage, model)].append((time.monotonic(), latency))
+            totals = self._totals[stage]
+            totals["calls"] += 1
+            totals["errors"] += error
+            totals["prompt_tokens"] += prompt_tokens
+            totals["completion_tokens"] += completion_tokens
+            totals["cost_usd"] += cost
+            totals["latency_total"] += latency
+        logging.info(f"LLM call stage={stage} model={model} latency={latency:.2f}s "
+                     f"tokens={prompt_tokens}+{completion_tokens} cost=${cost:.4f}")
+        try:
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps({
+                    "time": time.time(), "stage": stage, "model": model, "latency": round(latency, 3),
+                    "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                    "cost_usd": round(cost, 6), "error": error,
+                }) + "\n")
+        except OSError as e:
+            logging.error(f"Could not write LLM usage log: {e}")
+
+    def _latencies_since(self, stage, model, since):
+        return [latency for at, latency in self._latencies[(stage, model)] if at >= since]
+
+    def p95_latency(self, stage, model):
+        """
+        Returns the p95 latency of calls within the routing window, or None if there are too few.
+        """
+        with self._lock:
+            latencies = self._latencies_since(stage, model, time.monotonic() - ROUTING_WINDOW_SECONDS)
+        if len(latencies) < MIN_ROUTING_SAMPLES:
+            return None
+        return _percentile(latencies, 0.95)
+
+    def choose_model(self, stage, profile):
+        """
+        Picks the primary or fast model for a call based on the primary's observed p95 latency.
+
+        A stage switches to its fast model when the primary's p95 over enough recent calls exceeds
+        the budget, and switches back when its last few probe calls are all within budget. Until
+        there are enough samples to decide, it keeps its current route.
+        """
+        if not profile.fast_model or profile.p95_latency_budget is None:
+            return profile.model
+        now = time.monotonic()
+        with self._lock:
+            routed_since = self._routed_since.get(stage)
+            if routed_since is None:
+                # Calls from before the last switch back describe the slow spell that caused it
+                since = max(now - ROUTING_WINDOW_SECONDS, self._unrouted_since.get(stage, 0))
+                latencies = self._latencies_since(stage, profile.model, since)
+                if len(latencies) < MIN_ROUTING_SAMPLES or _percentile(latencies, 0.95) <= profile.p95_latency_budget:
+                    return profile.model
+                self._routed_since[stage] = now
+                self._routed_calls[stage] = 0
+                logging.warning(f"Routing stage {stage} to {profile.fast_model}: {profile.model} p95 "
+                                f"{_percentile(latencies, 0.95):.1f}s exceeds {profile.p95_latency_budget}s")
+            else:
+                probes = self._latencies_since(stage, profile.model, routed_since)[-MIN_PROBE_SAMPLES:]
+                if len(probes) == MIN_PROBE_SAMPLES and max(probes) <= profile.p95_latency_budget:
+                    del self._routed_since[stage]
+                    self._unrouted_since[stage] = now
+                    logging.info(f"Routing stage {stage} back to {profile.model}")
+                    return profile.model
+            self._routed_calls[stage] += 1
+            probe = self._routed_calls[stage] % PRIMARY_PROBE_INTERVAL == 0
+        return profile.model if probe else profile.fast_model
+
+    def report(self):
+        """
+        Summarizes usage per stage.
+
+        :return: A dict mapping each stage to its call count, errors, tokens, cost and latency percentiles by model.
+        """
+        with self._lock:
+            stages = {stage: dict(totals) for stage, totals in self._totals.items()}
+            latencies = {key: [latency for _, latency in values] for key, values in self._latencies.items()}
+        for stage, totals in stages.items():
+            totals["mean_latency"] = totals.pop("latency_total") / totals["calls"]
+            for counter in ("calls", "errors", "prompt_tokens", "completion_tokens"):
+                totals[counter] = int(totals[counter])
+            totals["models"] = {
+                model: {"p50": _percentile(values, 0.5), "p95": _percentile(values, 0.95), "samples": len(values)}
+                for (latency_stage, model), values in latencies.items() if latency_stage == stage and values
+            }
+        return stages
+
+
+usage_tracker = UsageTracker()
+
+
+def generate_ai_text(prompt: str, temperature: float = None, stage: str = "default") -> str:
+    """
+    Generates text based on the provided prompt using the model configured for the pipeline stage.
+
     :param prompt: The prompt to send to the model.
-    :param temperature: The temperature to use for the generation. Lower means more deterministic.
-    :return: The generated text as a string.
+    :param temperature: Overrides the stage's temperature. Lower means more deterministic.
+    :param stage: The key into STAGE_PROFILES selecting model, token limit and timeout.
+    :return: The generated text as a string, or TEXT_ERROR if the call failed or hit the stage's token limit.
     """
+    profile = STAGE_PROFILES.get(stage, STAGE_PROFILES["default"])
+    model = usage_tracker.choose_model(stage, profile)
+    start = time.perf_counter()
     try:
         response = openai.chat.completions.create(
-            model="gpt-4-1106-preview",
+            model=model,
             messages=[
-                {"role": "system", "content": f"Temperature: {temperature}"},
                 {"role": "user", "content": prompt},
             ],
-            max_tokens=3000,
+            max_tokens=profile.max_tokens,
             stop=None,
-            temperature=temperature
+            temperature=profile.temperature if temperature is None else temperature,
+            timeout=profile.timeout,
         )
-        return response.choices[0].message.content.strip()
+        usage = response.usage
+        choice = response.choices[0]
+        # Text cut off at max_tokens is incomplete, so callers must not use it as if it were whole
+        truncated = choice.finish_reason == "length"
+        usage_tracker.record(stage, model, time.perf_counter() - start,
+                             usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0,
+                             error=truncated)
+        if truncated:
+            logging.error(f"LLM response for stage {stage} was cut off at {profile.max_tokens} tokens")
+            return TEXT_ERROR
+        return choice.message.content.strip()
     except Exception as e:
+        usage_tracker.record(stage, model, time.perf_counter() - start, error=True)
         print(f"An error occurred: {e}")
-        return "Error generating text."
+        return TEXT_ERROR
 
 if __name__ == "__main__":
     # Test the function with a sample prompt
@@ -0,0 +1,57 @@
+import openai
+import os
+import base64
+import mimetypes
+
+# Ensure your OPENAI_API_KEY is set in your environment variables
+openai.api_key = os.getenv("OPENAI_API_KEY")
+
+IMAGE_ANALYSIS_PROMPT = """
+Describe the object in this image for someone who will design a 3D printable version of it or an accessory for it.
+Include its shape, approximate dimensions, and any notable features such as holes, slots, or mounting points.
+Keep your response under 80 words.
+"""
+
+ANALYSIS_ERROR = "Error analyzing image."
+
+
+class OpenAIVision:
+    def __init__(self, model="gpt-4-vision-preview", max_tokens=300):
+        self.model = model
+        self.max_tokens = max_tokens
+
+    def analyze_image(self, image, prompt=IMAGE_ANALYSIS_PROMPT, mime_type="image/jpeg"):
+        """
+        Describes an image using OpenAI's vision model.
+
+        :param image: Either a path to an image file or the encoded image bytes.
+        :param prompt: The instruction sent alongside the image.
+        :param mime_type: The MIME type of `image` when it is given as bytes.
+        :return: The analysis as a string.
+        """
+        if isinstance(image, (bytes, bytearray)):
+            image_bytes = bytes(image)
+        else:
+            mime_type = mimetypes.guess_type(image)[0] or mime_type
+            with open(image, "rb") as f:
+                image_bytes = f.read()
+
+        image_url = f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+        try:
+            response = openai.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "text", "text": prompt},
+                            {"type": "image_url", "image_url": {"url": image_url}},
+                        ],
+                    },
+                ],
+                max_tokens=self.max_tokens,
+            )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            return ANALYSIS_ERROR
@@ -22,7 +22,7 @@ def main():
             idea = speech_to_text.recognize_speech()
         elif USE_AI_FOR_IDEA:
             logging.info("Generating idea using AI...")
-            idea = generate_ai_text(cad_prompts.IDEA_GENERATION, 0.8)  # Adjust temperature as needed
+            idea = generate_ai_text(cad_prompts.IDEA_GENERATION, 0.8, stage="idea")  # Adjust temperature as needed
         else:
             idea = input("Please type your idea for a CAD object: ")
 
@@ -30,7 +30,7 @@ def main():
 
         # Generate manufacturing instructions
         instructions_prompt = cad_prompts.MANUFACTURING_INSTRUCTIONS.format(user_idea=idea)
-        manufacturing_instructions = generate_ai_text(instructions_prompt, 0.8)
+        manufacturing_instructions = generate_ai_text(instructions_prompt, 0.8, stage="manufacturing_instructions")
         logging.info(f"Manufacturing Instructions:\n{manufacturing_instructions}")
 
         # Generate the CAD model using the final instructions
@@ -0,0 +1,106 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from config import DATA_DIR
+from artifacts import load_mesh
+
+THUMBNAIL_DIR = os.path.join(DATA_DIR, "thumbnails")
+THUMBNAIL_SIZE = 256
+# VTK rendering is CPU bound, so thumbnails render in separate processes
+RENDER_WORKERS = int(os.getenv("ALMECHE_RENDER_WORKERS", "2"))
+# Seconds before a failed render is tried again, so a transient failure doesn't stick
+RENDER_RETRY_INTERVAL = 300
+
+_pool = None
+_pending = {}
+_failed = {}  # artifact ID -> monotonic time of the last failed render
+# Reentrant because a done callback runs immediately if the future has already finished
+_lock = threading.RLock()
+
+
+def thumbnail_path(artifact_id):
+    return os.path.join(THUMBNAIL_DIR, artifact_id[:2], f"{artifact_id}.png")
+
+
+def render_thumbnail(artifact_id):
+    """
+    Renders an offscreen PNG thumbnail of a stored STL artifact. Runs inside the render pool.
+
+    :return: The path of the rendered thumbnail.
+    """
+    import numpy as np
+    import pyvista as pv
+
+    path = thumbnail_path(artifact_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pv.global_theme.allow_empty_mesh = True
+    plotter = pv.Plotter(off_screen=True, window_size=[THUMBNAIL_SIZE, THUMBNAIL_SIZE])
+    try:
+        vertices, faces = load_mesh(artifact_id)
+        # PyVista's face array prefixes every face with its vertex count
+        cells = np.column_stack([np.full(len(faces), 3, dtype=np.int64), faces]).ravel()
+        mesh = pv.PolyData(np.asarray(vertices), cells)
+        plotter.add_mesh(mesh, color='white', show_edges=True)
+        plotter.view_isometric()
+        plotter.background_color = 'white'
+        tmp_path = f"{path}.tmp{os.getpid()}.png"
+        plotter.screenshot(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        plotter.close()
+    return path
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # Forking a process that has already initialised VTK or Streamlit's threads is unsafe
+        _pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _on_rendered(artifact_id, future):
+    global _pool
+    with _lock:
+        _pending.pop(artifact_id, None)
+        if isinstance(future.exception(), BrokenProcessPool):
+            # A crashed worker poisons the whole pool; start a fresh one for later requests
+            _pool = None
+        elif future.exception():
+            _failed[artifact_id] = time.monotonic()
+    if future.exception():
+        logging.error(f"Failed to render thumbnail for {artifact_id}: {future.exception()}")
+
+
+def is_rendering(artifact_id):
+    with _lock:
+        return artifact_id in _pending
+
+
+def request_thumbnails(artifact_ids):
+    """
+    Returns cached thumbnails and queues rendering for any that are missing.
+
+    :param artifact_ids: The artifacts to get thumbnails for.
+    :return: A dict mapping each artifact ID to its thumbnail path, or None while it is rendering or if it failed.
+    """
+    thumbnails = {}
+    retry_before = time.monotonic() - RENDER_RETRY_INTERVAL
+    with _lock:
+        for artifact_id in artifact_ids:
+            path = thumbnail_path(artifact_id)
+            if os.path.exists(path):
+                thumbnails[artifact_id] = path
+                continue
+            thumbnails[artifact_id] = None
+            if artifact_id in _failed and _failed[artifact_id] < retry_before:
+                del _failed[artifact_id]
+            if artifact_id not in _pending and artifact_id not in _failed:
+                future = _get_pool().submit(render_thumbnail, artifact_id)
+                _pending[artifact_id] = future
+                future.add_done_callback(lambda f, artifact_id=artifact_id: _on_rendered(artifact_id, f))
+    return thumbnails
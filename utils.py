@@ -6,12 +6,17 @@ import pyvista as pv
 from stpyvista import stpyvista
 import streamlit as st
 import cad_prompts
-from openai_text import generate_ai_text
+from openai_text import generate_ai_text, TEXT_ERROR
 import logging
 import time
 import requests
 from dotenv import load_dotenv
 import base64
+import mmap
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageOps, ImageChops
+from openai_vision import ANALYSIS_ERROR
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -29,6 +34,10 @@ BASE_URL = "https://api.zoo.dev"
 TEXT_TO_CAD_ENDPOINT = f"{BASE_URL}/ai/text-to-cad/{{output_format}}"
 USER_TEXT_TO_CAD_STATUS_ENDPOINT = f"{BASE_URL}/user/text-to-cad/{{operation_id}}"
 
+# Seconds to wait after each status check, and between checks while polling
+STATUS_CHECK_DELAY = 8
+POLL_INTERVAL = 5
+
 def text_to_cad(description: str, output_format: str):
     headers = {
         "Authorization": f"Bearer {KITTYCAD_API_TOKEN}",
@@ -63,18 +72,60 @@ def text_to_cad(description: str, output_format: str):
         logging.exception(f"An error occurred while initiating the CAD model generation: {e}")
         return None
 
-def decode_file_content(base64_content: str):
-    # Fix padding if necessary
-    base64_content += "=" * ((4 - len(base64_content) % 4) % 4)
+# Decoded outputs larger than this are written to an anonymous spill file and memory-mapped
+DECODE_SPILL_THRESHOLD = 32 * 1024 * 1024
+# Base64 characters decoded per step; must be a multiple of 4
+DECODE_CHUNK_CHARS = 4 * 64 * 1024
+
+_URLSAFE_TO_STANDARD = str.maketrans("-_", "+/")
+
+
+def decode_file_content(base64_content: str, spill_threshold: int = DECODE_SPILL_THRESHOLD):
+    """
+    Decodes base64 file content incrementally into a buffer allocated once at its final size.
+
+    :param base64_content: The base64 text, with or without padding.
+    :param spill_threshold: Decoded size above which the buffer is a memory-mapped temporary file.
+    :return: A bytes-like object (bytearray or mmap) with the file data, or None if decoding fails.
+    """
+    # Line-wrapped base64 is valid input; split() returns the string itself when it has no whitespace
+    data = "".join(base64_content.split()).rstrip("=")
+    remainder = len(data) % 4
+    if remainder == 1:
+        logging.error("An error occurred while decoding the file content: invalid base64 length")
+        return None
+    decoded_size = len(data) // 4 * 3 + max(remainder - 1, 0)
+
+    if decoded_size > spill_threshold:
+        with tempfile.TemporaryFile() as spill:
+            spill.truncate(decoded_size)
+            buffer = mmap.mmap(spill.fileno(), decoded_size)
+    else:
+        buffer = bytearray(decoded_size)
+
     try:
-        file_data = base64.b64decode(base64_content)
+        offset = 0
+        for start in range(0, len(data), DECODE_CHUNK_CHARS):
+            chunk = data[start:start + DECODE_CHUNK_CHARS].translate(_URLSAFE_TO_STANDARD)
+            chunk += "=" * (-len(chunk) % 4)  # Only the final chunk can need padding
+            decoded = base64.b64decode(chunk, validate=True)
+            buffer[offset:offset + len(decoded)] = decoded
+            offset += len(decoded)
         logging.info("File content decoded successfully.")
-        return file_data
-    except base64.binascii.Error as e:
+        return buffer
+    except (base64.binascii.Error, ValueError, IndexError) as e:
         logging.error(f"An error occurred while decoding the file content: {e}")
+        if isinstance(buffer, mmap.mmap):
+            buffer.close()
         return None
 
-def check_model_generation_status(operation_id: str):
+def check_model_generation_status(operation_id: str, output_formats=None):
+    """
+    Checks a Text-to-CAD operation, decoding its outputs once it has completed.
+
+    :param operation_id: The operation to check.
+    :param output_formats: Optional file extensions (e.g. ("stl",)) to decode; other outputs are skipped.
+    """
     headers = {
         "Authorization": f"Bearer {KITTYCAD_API_TOKEN}"
     }
@@ -86,15 +137,21 @@ def check_model_generation_status(operation_id: str):
         response.raise_for_status()
 
         if response.status_code == 200:
-            operation_status = response.json().get("status")
+            body = response.json()
+            # Free the raw body now so it isn't held alongside the parsed base64 while decoding
+            del response
+            operation_status = body.get("status")
             logging.info(f"Model generation status: {operation_status}")
             
             # Return decoded content when the operation is completed
             if operation_status == 'completed':
-                outputs = response.json().get('outputs')
+                suffixes = tuple(f".{fmt.lower()}" for fmt in output_formats) if output_formats else None
+                outputs = body.get('outputs') or {}
                 decoded_contents = {}
-                for file_name, base64_content in outputs.items():
-                    file_data = decode_file_content(base64_content)
+                for file_name in list(outputs):
+                    if suffixes and not file_name.lower().endswith(suffixes):
+                        continue
+                    file_data = decode_file_content(outputs.pop(file_name))
                     if file_data:
                         decoded_contents[file_name] = file_data
                 return {"status": operation_status, "files": decoded_contents}
@@ -111,43 +168,54 @@ def check_model_generation_status(operation_id: str):
     except Exception as e:
         logging.exception(f"An error occurred while checking the model generation status: {e}")
     finally:
-        time.sleep(8)  # Avoid rapid polling
+        time.sleep(STATUS_CHECK_DELAY)  # Avoid rapid polling
 
 
 
 def generate_formatted_instructions(user_intent):
     try:
         instructions_prompt = cad_prompts.MANUFACTURING_INSTRUCTIONS.format(user_idea=user_intent)
-        manufacturing_instructions = generate_ai_text(instructions_prompt, 0.808)
+        manufacturing_instructions = generate_ai_text(instructions_prompt, stage="manufacturing_instructions")
+        if manufacturing_instructions == TEXT_ERROR:
+            return False, "Failed to generate manufacturing instructions."
         formatted_prompt = cad_prompts.FORMATTED_INSTRUCTIONS.format(manufacturing_instructions=manufacturing_instructions)
-        formatted_instructions = generate_ai_text(formatted_prompt, 0.808)
+        formatted_instructions = generate_ai_text(formatted_prompt, stage="formatted_instructions")
+        if formatted_instructions == TEXT_ERROR:
+            return False, "Failed to format the manufacturing instructions."
         return True, formatted_instructions
     except Exception as e:
         logging.exception("An error occurred during generating formatted instructions: {}".format(str(e)))
         return False, "An unexpected error occurred during the process."
 
 
-def generate_stl_model(formatted_instructions):
+def generate_stl_model(formatted_instructions, on_status=None):
+    """
+    Generates an STL model and polls until it completes.
+
+    :param formatted_instructions: The Text-to-CAD prompt.
+    :param on_status: Optional callable invoked with each polled status, for progress reporting.
+    """
     try:
         # Ensure only STL format is requested
         operation_id = text_to_cad(formatted_instructions, "stl")
         if not operation_id:
-            return "Failed", "Failed to initiate model generation.", None
+            return "Failed", "Failed to initiate model generation."
 
         # Poll for the model generation status
         while True:
-            result = check_model_generation_status(operation_id)
+            result = check_model_generation_status(operation_id, output_formats=("stl",))
             if result:
                 model_status = result.get("status")
+                if on_status:
+                    on_status(model_status)
                 if model_status == "completed":
-                    # Filter the result to ensure only STL files are processed
-                    stl_files = {k: v for k, v in result.get("files", {}).items() if k.endswith('.stl')}
-                    return "Completed", stl_files
+                    # Only STL outputs were decoded
+                    return "Completed", result.get("files", {})
                 elif model_status == "failed":
                     return "Failed", "Model generation failed."
             else:
                 return "Failed", "Failed to check model generation status."
-            time.sleep(5)
+            time.sleep(POLL_INTERVAL)
     except Exception as e:
         logging.exception("An error occurred during the STL generation process: {}".format(str(e)))
         return "Error", "An unexpected error occurred during the process."
@@ -183,25 +251,125 @@ def speech_to_text(audio_data):
             return f"Could not request results from Google Speech Recognition service; {e}"
 
 
-def save_uploaded_file(uploaded_file):
+# The vision model fits images within 2048x2048 and then scales the short side to 768px,
+# so anything larger is discarded upstream anyway.
+VISION_MAX_LONG_SIDE = 2048
+VISION_MAX_SHORT_SIDE = 768
+VISION_JPEG_QUALITY = 85
+
+# A cached analysis is only reused for an image of the same size whose difference hash is
+# within IMAGE_HASH_MAX_DISTANCE of 64 bits and whose colour thumbnail differs by at most
+# IMAGE_MAX_PIXEL_DIFFERENCE (out of 255) in every pixel and channel
+IMAGE_HASH_MAX_DISTANCE = 2
+IMAGE_MAX_PIXEL_DIFFERENCE = 24
+IMAGE_THUMBNAIL_SIZE = 32
+IMAGE_ANALYSIS_CACHE_SIZE = 256
+
+_image_analysis_cache = OrderedDict()
+_image_analysis_cache_lock = threading.Lock()
+
+
+def _vision_target_size(width, height):
+    scale = min(1.0, VISION_MAX_LONG_SIDE / max(width, height))
+    scale = min(scale, VISION_MAX_SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _difference_hash(image):
+    """
+    Computes a 64-bit difference hash; visually similar images give hashes with a small Hamming distance.
+    """
+    pixels = list(image.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+class ImageFingerprint:
     """
-    Saves an uploaded file to a temporary file.
+    Identifies a preprocessed image closely enough to decide whether two uploads show the same picture.
 
-    :param uploaded_file: The uploaded file to save.
-    :return: The path to the saved temporary file or None if saving fails.
+    The difference hash only captures coarse brightness gradients, so plain-background photos of
+    different objects can share one; a hash hit is confirmed against a small colour thumbnail.
+    """
+
+    def __init__(self, image):
+        self.size = image.size
+        self.hash = _difference_hash(image)
+        self.thumbnail = image.resize((IMAGE_THUMBNAIL_SIZE, IMAGE_THUMBNAIL_SIZE), Image.BILINEAR)
+
+    def matches(self, other):
+        if self.size != other.size or bin(self.hash ^ other.hash).count("1") > IMAGE_HASH_MAX_DISTANCE:
+            return False
+        extrema = ImageChops.difference(self.thumbnail, other.thumbnail).getextrema()
+        return max(high for _, high in extrema) <= IMAGE_MAX_PIXEL_DIFFERENCE
+
+
+def preprocess_image(image_bytes):
+    """
+    Decodes an uploaded image once, downscales it to the resolution the vision model uses and re-encodes it.
+
+    :param image_bytes: The raw uploaded image.
+    :return: A tuple of (JPEG bytes, ImageFingerprint).
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    # Let the JPEG decoder skip detail we are about to throw away
+    image.draft("RGB", _vision_target_size(*image.size))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    target_size = _vision_target_size(*image.size)
+    if target_size != image.size:
+        image = image.resize(target_size, Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    return output.getvalue(), ImageFingerprint(image)
+
+
+def _lookup_image_analysis(fingerprint):
+    with _image_analysis_cache_lock:
+        for key, (cached_fingerprint, analysis) in _image_analysis_cache.items():
+            if cached_fingerprint.matches(fingerprint):
+                _image_analysis_cache.move_to_end(key)
+                return analysis
+    return None
+
+
+def _store_image_analysis(fingerprint, analysis):
+    key = (fingerprint.size, fingerprint.thumbnail.tobytes())
+    with _image_analysis_cache_lock:
+        _image_analysis_cache[key] = (fingerprint, analysis)
+        _image_analysis_cache.move_to_end(key)
+        while len(_image_analysis_cache) > IMAGE_ANALYSIS_CACHE_SIZE:
+            _image_analysis_cache.popitem(last=False)
+
+
+def analyze_uploaded_image(vision_model, uploaded_file):
+    """
+    Analyzes an uploaded image in memory, reusing the analysis of any near-identical image seen before.
+
+    :param vision_model: The OpenAIVision instance to use on a cache miss.
+    :param uploaded_file: The uploaded image file.
+    :return: The image analysis, or None if the image could not be processed or analyzed.
     """
     try:
-        # Create a temporary file with a suffix matching the uploaded file's extension
-        suffix = os.path.splitext(uploaded_file.name)[1]
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, mode='wb') as tmp:
-            # Read the contents of the uploaded file and write them to the temporary file
-            contents = uploaded_file.getvalue()
-            tmp.write(contents)
-            # Return the path to the temporary file
-            return tmp.name
+        image_bytes, fingerprint = preprocess_image(uploaded_file.getvalue())
     except Exception as e:
-        st.error(f"Error saving file: {e}")
+        st.error(f"Error processing image: {e}")
+        return None
+
+    analysis = _lookup_image_analysis(fingerprint)
+    if analysis is not None:
+        logging.info(f"Reusing cached analysis for image hash {fingerprint.hash:016x}")
+        return analysis
+
+    analysis = vision_model.analyze_image(image_bytes, mime_type="image/jpeg")
+    if analysis == ANALYSIS_ERROR:
+        st.error("The image could not be analyzed. Please try again.")
         return None
+    _store_image_analysis(fingerprint, analysis)
+    return analysis
 
 
 def find_latest_stl(base_dir):
@@ -223,8 +391,8 @@ def visualize_stl(stl_data_bytes):
     """
     Visualizes an STL file using PyVista within Streamlit, directly from binary data.
     """
-    if not isinstance(stl_data_bytes, bytes):
-        st.error("STL data must be a bytes object.")
+    if not isinstance(stl_data_bytes, (bytes, bytearray, memoryview, mmap.mmap)):
+        st.error("STL data must be a bytes-like object.")
         return
     
     # Create a temporary file to save the STL data